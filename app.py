@@ -1,9 +1,15 @@
-from fastapi import FastAPI, Depends
+from contextlib import asynccontextmanager
+import anyio.to_thread
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
+import os
 import sys
-from claude2api.auth import verify_token
+from claude2api.auth import AuthMiddleware
+from claude2api.claude_client import close_sessions
+from claude2api.claude_pipeline import claude_pipeline
 from claude2api.config import get_config
+from claude2api.models import OpenAIResponse
 from claude2api.handlers import (
     health_check_handler,
     modules_handler,
@@ -14,29 +20,58 @@ logger.remove()
 logger.add(
     sys.stderr, format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}", level="INFO"
 )
-logger.add("logs/file_{time}.log", rotation="10 MB", level="INFO")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 提高 AnyIO 线程池上限（默认 40），避免同步依赖项和处理函数在突发负载下排队
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = int(os.getenv("AIO_THREAD_TOKENS", "200"))
+
+    # 文件日志在启动钩子中添加，只有实际服务的进程才会创建日志文件，
+    # 并在关闭时移除，避免重载时重复叠加；enqueue 使写盘在后台线程完成，不阻塞事件循环
+    file_sink_id = logger.add(
+        "logs/file_{time}.log",
+        rotation="10 MB",
+        compression="gz",
+        level="INFO",
+        enqueue=True,
+    )
+    yield
+    # 等待尚未完成的会话清理任务，避免关闭时丢失
+    await claude_pipeline.conversation_manager.wait_for_cleanup()
+    await close_sessions()
+    logger.remove(file_sink_id)
+
 
 # 初始化 FastAPI 应用
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+config_instance = get_config()
+
+# 添加 API 密钥验证中间件（需先于 CORS 添加，使 CORS 位于外层处理预检请求）
+app.add_middleware(AuthMiddleware, api_key=config_instance.api_key)
 
 # 添加 CORS 中间件
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # 允许所有来源
+    allow_origins=config_instance.cors_origins,  # 允许的来源，默认所有来源
     allow_credentials=True,  # 允许携带凭据
-    allow_methods=["POST", "GET", "OPTIONS", "PUT", "DELETE"],  # 允许特定的 HTTP 方法
-    allow_headers=[
+    allow_methods=("GET", "POST", "OPTIONS"),  # 仅允许已注册路由使用的方法
+    allow_headers=(
         "Content-Type",
         "Content-Length",
         "Accept-Encoding",
         "Authorization",
-    ],  # 允许特定的Header
+    ),  # 允许特定的Header
+    max_age=86400,  # 浏览器缓存预检结果一天，省去后续请求的预检往返
 )
 
 # 注册路由
 app.get("/health")(health_check_handler)
-app.get("/v1/models", dependencies=[Depends(verify_token)])(modules_handler)
-app.post("/v1/chat/completions", dependencies=[Depends(verify_token)])(
+app.get("/v1/models")(modules_handler)
+# OpenAIResponse 仅用于 OpenAPI 文档，处理函数直接返回已序列化的响应
+app.post("/v1/chat/completions", response_model=OpenAIResponse)(
     chat_completions_handler
 )
 
@@ -45,9 +80,25 @@ if __name__ == "__main__":
     import uvicorn
 
     # 从配置中获取地址和端口
-    config = get_config()
-    host, port_str = config.address.split(":")
+    host, port_str = config_instance.address.split(":")
     port = int(port_str)
 
-    logger.info(f"正在启动 Uvicorn 服务器，地址: {host}，端口: {port}...")
-    uvicorn.run(app, host=host, port=port)
+    # 工作进程数，环境变量 UVICORN_WORKERS 优先于配置文件
+    workers = int(os.getenv("UVICORN_WORKERS", config_instance.workers))
+
+    logger.info(
+        f"正在启动 Uvicorn 服务器，地址: {host}，端口: {port}，工作进程数: {workers}..."
+    )
+    # 多进程模式下必须以导入字符串的形式传入应用
+    uvicorn.run(
+        "app:app",
+        host=host,
+        port=port,
+        workers=workers,
+        limit_concurrency=config_instance.limit_concurrency,  # 超出时直接返回 503
+        backlog=2048,
+        timeout_keep_alive=30,
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+        log_level="info",
+    )
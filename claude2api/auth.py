@@ -1,42 +1,79 @@
-from fastapi import Request, HTTPException, Depends
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import hmac
+import orjson
+from fastapi.responses import Response
 from typing import Optional
 from claude2api.config import get_config, SessionInfo
 
-# 创建用于处理Bearer令牌的安全组件
-security = HTTPBearer(auto_error=False)
-
 config_instance = get_config()
 
+# 401 响应体是固定的，在导入时序列化一次，格式与 HTTPException 保持一致
+_ERR_MISSING = orjson.dumps({"detail": {"error": "缺少或无效的Authorization头信息"}})
+_ERR_INVALID = orjson.dumps({"detail": {"error": "无效的API密钥"}})
 
-# 验证API密钥的依赖项
-async def verify_token(
-    request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)
-):
-    # 验证Authorization头
-    if not credentials:
-        raise HTTPException(
-            status_code=401, detail={"error": "缺少或无效的Authorization头信息"}
-        )
 
-    # 提取并验证API密钥
-    token = credentials.credentials
-    if token != config_instance.api_key:
-        raise HTTPException(status_code=401, detail={"error": "无效的API密钥"})
+class AuthMiddleware:
+    """API密钥验证中间件
+
+    直接读取 ASGI scope 中的 Authorization 头，并使用常量时间比较验证密钥，
+    避免依赖注入和凭据模型的开销。
+    """
+
+    # 需要验证的路径前缀，/health 等其他路径不受影响
+    PROTECTED_PREFIX = "/v1/"
+
+    def __init__(self, app, api_key: str):
+        self.app = app
+        # 预先编码期望的密钥，请求时直接比较字节
+        # 未配置密钥时为 None，拒绝所有请求
+        self.expected = api_key.encode() if api_key else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(
+            self.PROTECTED_PREFIX
+        ):
+            await self.app(scope, receive, send)
+            return
 
-    return True
+        # 提取Authorization头
+        auth_header = b""
+        for key, value in scope["headers"]:
+            if key == b"authorization":
+                auth_header = value
+                break
 
+        # 验证Authorization头，认证方案与 HTTPBearer 一样不区分大小写
+        scheme, _, token = auth_header.partition(b" ")
+        if scheme.lower() != b"bearer" or not token:
+            await self._reject(scope, receive, send, _ERR_MISSING)
+            return
 
-async def extract_session_from_auth_header(request) -> Optional[SessionInfo]:
+        # 仅对令牌做常量时间比较，未配置密钥时拒绝所有请求
+        if self.expected is None or not hmac.compare_digest(token, self.expected):
+            await self._reject(scope, receive, send, _ERR_INVALID)
+            return
+
+        await self.app(scope, receive, send)
+
+    @staticmethod
+    async def _reject(scope, receive, send, body: bytes) -> None:
+        """返回预先序列化的 401 响应"""
+        response = Response(
+            content=body, status_code=401, media_type="application/json"
+        )
+        await response(scope, receive, send)
+
+
+def extract_session_from_auth_header(request) -> Optional[SessionInfo]:
     """从请求头中提取会话信息"""
     auth_info = request.headers.get("Authorization", "")
-    auth_info = auth_info.replace("Bearer ", "")
+    # 认证方案不区分大小写，没有方案时整个头即为会话信息
+    scheme, _, token = auth_info.partition(" ")
+    if scheme.lower() == "bearer":
+        auth_info = token
 
     if not auth_info:
         return None
 
-    if ":" in auth_info:
-        parts = auth_info.split(":")
-        return SessionInfo(session_key=parts[0], org_id=parts[1])
-
-    return SessionInfo(session_key=auth_info, org_id="")
+    # 仅在第一个冒号处拆分，组织ID中的冒号得以保留
+    session_key, _, org_id = auth_info.partition(":")
+    return SessionInfo(session_key=session_key, org_id=org_id)
@@ -1,15 +1,49 @@
 from loguru import logger
-import json
+import asyncio
+import orjson
 import uuid
 import base64
-from typing import List, Dict, Any, AsyncGenerator
+from typing import List, Dict, Any, AsyncGenerator, Optional, Tuple, TypedDict
+from curl_cffi import CurlMime
 from curl_cffi.requests import AsyncSession
 from curl_cffi.requests.models import Response as curl_Response
-from pydantic import BaseModel
+from claude2api.config import _mask, get_config
 
 
-class Organization(BaseModel):
-    """组织信息模型"""
+# 获取配置实例
+config_instance = get_config()
+
+# 按 (代理, 会话密钥) 共享的 curl_cffi 会话
+_SESSION_POOL: Dict[Tuple[str, str], AsyncSession] = {}
+
+# 按会话密钥缓存的组织 ID，预先填入配置中已知的组织 ID
+_ORG_ID_CACHE: Dict[str, str] = {
+    session.session_key: session.org_id
+    for session in config_instance.sessions
+    if session.org_id
+}
+
+# 上传文件时内容类型对应的文件名，可以根据需要添加更多文件类型
+UPLOAD_FILENAMES = {
+    "image/jpeg": "image.jpg",
+    "image/png": "image.png",
+    "application/pdf": "document.pdf",
+}
+
+# 单个请求中同时上传的文件数上限
+UPLOAD_CONCURRENCY = 6
+
+# SSE 数据行前缀
+SSE_DATA_PREFIX = b"data: "
+SSE_DATA_PREFIX_LEN = len(SSE_DATA_PREFIX)
+# 需要处理的事件在原始字节中必然包含的标记，用于在 JSON 解析前快速跳过其他事件
+# （message_start、content_block_start/stop、message_stop、ping 等）
+SSE_DELTA_MARKER = b'_delta"'
+SSE_ERROR_MARKER = b'"error"'
+
+
+class Organization(TypedDict):
+    """组织信息结构，接口返回的数据直接按字典访问，不做模型校验"""
 
     id: int
     uuid: str
@@ -31,6 +65,19 @@ class ClaudeClient:
         "priority": "u=1, i",
     }
 
+    # 各接口固定不变的请求头，预先构建避免每次请求重复创建
+    NEW_CHAT_HEADERS = {"referer": "https://claude.ai/new"}
+    SEND_MESSAGE_HEADERS = {
+        "accept": "text/event-stream, text/event-stream",
+        "anthropic-client-platform": "web_claude_ai",
+        "cache-control": "no-cache",
+    }
+    UPLOAD_HEADERS = {
+        "referer": "https://claude.ai/new",
+        "anthropic-client-platform": "web_claude_ai",
+        "content-type": "multipart/form-data",  # fix upload file error bug
+    }
+
     # 默认请求属性
     DEFAULT_ATTRS = {
         "personalized_styles": [
@@ -59,23 +106,34 @@ class ClaudeClient:
         "timezone": "America/New_York",
     }
 
-    def __init__(self, session_key: str, proxy: str = ""):
+    def __init__(self, session_key: str, proxy: str = "", org_id: str = ""):
         """初始化 Claude 客户端
 
+        除 get_org_id 外的接口都要求组织 ID 已知，应通过 new_client 创建客户端。
+
         Args:
             session_key: Claude 会话密钥
             proxy: 代理服务器地址
+            org_id: 组织 ID
         """
         self.session_key = session_key
-        self.org_id = ""
+        self.org_id = org_id
         self.proxy = proxy
-        self.request_attrs = self.DEFAULT_ATTRS.copy()
+        # 默认与 DEFAULT_ATTRS 共享，只在首次添加文件或附件时复制（见 _extend_request_attr）
+        self.request_attrs: Dict[str, Any] = self.DEFAULT_ATTRS
+        # 请求体中除 prompt 外的部分，request_attrs 修改后置为 None 以便重新序列化
+        self._body_prefix: Optional[bytes] = _DEFAULT_BODY_PREFIX
+        # 会话 ID -> 该会话的 referer 请求头
+        self._conversation_headers: Dict[str, Dict[str, str]] = {}
 
         # 创建会话
         self.session = self._create_session(session_key, proxy)
 
     def _create_session(self, session_key: str, proxy: str) -> AsyncSession:
-        """创建 curl_cffi 会话
+        """获取 curl_cffi 会话
+
+        同一会话密钥和代理的客户端共享一个会话及其连接池，
+        避免每个请求都重新进行 TCP 和 TLS 握手。
 
         Args:
             session_key: 会话密钥
@@ -84,17 +142,51 @@ class ClaudeClient:
         Returns:
             AsyncSession: 配置好的会话对象
         """
-        return AsyncSession(
-            impersonate="chrome",
-            timeout=300,
-            proxy=proxy if proxy else "",
-            headers=self.DEFAULT_HEADERS,
-            cookies={"sessionKey": session_key},
-        )
+        pool_key = (proxy, session_key)
+        session = _SESSION_POOL.get(pool_key)
+        if session is None:
+            session = AsyncSession(
+                impersonate="chrome",
+                timeout=300,
+                proxy=proxy if proxy else "",
+                headers=self.DEFAULT_HEADERS,
+                cookies={"sessionKey": session_key},
+                # 共享会话需要容纳该会话密钥上的全部并发请求
+                max_clients=config_instance.upstream_concurrency,
+            )
+            _SESSION_POOL[pool_key] = session
+        return session
 
     async def get_org_id(self) -> str:
         """获取组织 ID
 
+        结果按会话密钥缓存，同一会话只需请求一次 /organizations。
+
+        Returns:
+            str: 组织 ID
+
+        Raises:
+            Exception: 获取失败时抛出异常
+        """
+        org_id = _ORG_ID_CACHE.get(self.session_key)
+        if org_id:
+            return org_id
+
+        org_id = await self._fetch_org_id()
+        _ORG_ID_CACHE[self.session_key] = org_id
+        return org_id
+
+    def _invalidate_org_id(self) -> None:
+        """认证失败时清除缓存的组织 ID，下次创建客户端时重新获取"""
+        logger.warning(
+            "会话 {} 认证失败，清除缓存的组织 ID", _mask(self.session_key)
+        )
+        _ORG_ID_CACHE.pop(self.session_key, None)
+        config_instance.clear_session_org_id(self.session_key)
+
+    async def _fetch_org_id(self) -> str:
+        """从 Claude API 获取组织 ID
+
         Returns:
             str: 组织 ID
 
@@ -105,37 +197,26 @@ class ClaudeClient:
 
         try:
             response: curl_Response = await self.session.get(
-                url, headers={"referer": "https://claude.ai/new"}
+                url, headers=self.NEW_CHAT_HEADERS
             )
 
             if response.status_code != 200:
                 raise Exception(f"获取组织 ID 失败，状态码: {response.status_code}")
 
             # 解析为具有明确结构的组织列表
-            orgs_data: List[Dict[str, Any]] = response.json()
+            orgs: List[Organization] = response.json()
 
-            if not orgs_data:
+            if not orgs:
                 raise Exception("未找到组织")
 
-            # 转换为Organization对象列表
-            orgs: List[Organization] = [
-                Organization(
-                    id=org.get("id", 0),
-                    uuid=org.get("uuid", ""),
-                    name=org.get("name", ""),
-                    rate_limit_tier=org.get("rate_limit_tier", ""),
-                )
-                for org in orgs_data
-            ]
-
             # 优先使用单一组织或默认组织
             if len(orgs) == 1:
-                return orgs[0].uuid
+                return orgs[0]["uuid"]
 
             # 查找默认组织
             for org in orgs:
-                if org.rate_limit_tier == "default_claude_ai":
-                    return org.uuid
+                if org.get("rate_limit_tier") == "default_claude_ai":
+                    return org["uuid"]
 
             raise Exception("未找到默认组织")
 
@@ -143,14 +224,6 @@ class ClaudeClient:
             logger.error(f"获取组织 ID 失败: {e}")
             raise
 
-    def set_org_id(self, org_id: str) -> None:
-        """设置组织 ID
-
-        Args:
-            org_id: 组织 ID
-        """
-        self.org_id = org_id
-
     async def create_conversation(self, model: str) -> str:
         """创建会话并返回会话 ID
 
@@ -161,11 +234,8 @@ class ClaudeClient:
             str: 会话 ID
 
         Raises:
-            Exception: 未设置组织 ID 或创建失败时抛出
+            Exception: 创建失败时抛出
         """
-        if not self.org_id:
-            raise Exception("未设置组织 ID")
-
         url = f"{self.BASE_URL}/organizations/{self.org_id}/chat_conversations"
 
         # 准备请求体
@@ -183,10 +253,12 @@ class ClaudeClient:
 
         try:
             response: curl_Response = await self.session.post(
-                url, json=request_body, headers={"referer": "https://claude.ai/new"}
+                url, data=orjson.dumps(request_body), headers=self.NEW_CHAT_HEADERS
             )
 
             if response.status_code != 201:
+                if response.status_code in (401, 403):
+                    self._invalidate_org_id()
                 raise Exception(f"创建会话失败，状态码: {response.status_code}")
 
             result: dict = response.json()
@@ -195,12 +267,30 @@ class ClaudeClient:
             if not conversation_id:
                 raise Exception("响应中未找到会话 ID")
 
+            self._conversation_headers[conversation_id] = {
+                "referer": f"https://claude.ai/chat/{conversation_id}"
+            }
             return conversation_id
 
         except Exception as e:
             logger.error(f"创建会话失败: {e}")
             raise
 
+    def _get_conversation_headers(self, conversation_id: str) -> Dict[str, str]:
+        """获取会话的 referer 请求头，本客户端创建的会话已预先缓存
+
+        Args:
+            conversation_id: 会话 ID
+
+        Returns:
+            Dict[str, str]: 请求头
+        """
+        headers = self._conversation_headers.get(conversation_id)
+        if headers is None:
+            headers = {"referer": f"https://claude.ai/chat/{conversation_id}"}
+            self._conversation_headers[conversation_id] = headers
+        return headers
+
     async def send_message(
         self, conversation_id: str, message: str, stream: bool
     ) -> AsyncGenerator[Dict[str, Any], None]:
@@ -211,33 +301,38 @@ class ClaudeClient:
             message: 消息内容
             stream: 是否流式响应
         """
-        if not self.org_id:
-            # 直接抛出异常，因为这是客户端配置问题，不是流中的事件
-            raise Exception("未设置组织 ID")
-
         url = f"{self.BASE_URL}/organizations/{self.org_id}/chat_conversations/{conversation_id}/completion"
 
-        # 创建请求体
-        request_body = self.request_attrs.copy()
-        request_body["prompt"] = message
+        # 创建请求体：拼接预先序列化的请求属性和单独编码的 prompt
+        if self._body_prefix is None:
+            self._body_prefix = _serialize_body_prefix(self.request_attrs)
+        request_body = self._body_prefix + orjson.dumps(message) + b"}"
 
         response: curl_Response = await self.session.post(
             url,
-            json=request_body,
+            data=request_body,
             headers={
-                "referer": f"https://claude.ai/chat/{conversation_id}",
-                "accept": "text/event-stream, text/event-stream",
-                "anthropic-client-platform": "web_claude_ai",
-                "cache-control": "no-cache",
+                **self.SEND_MESSAGE_HEADERS,
+                **self._get_conversation_headers(conversation_id),
             },
             stream=True,
         )
 
-        logger.info(f"Claude 响应状态码: {response.status_code}")
+        logger.info("Claude 响应状态码: {}", response.status_code)
 
         # 在开始流式处理前检查初始状态码
         if response.status_code == 429:
-            yield {"type": "error", "content": "Rate limit exceeded"}
+            await response.aclose()
+            yield {
+                "type": "error",
+                "content": "Rate limit exceeded",
+                "session_failed": True,
+            }
+            return  # 停止生成器
+        elif response.status_code in (401, 403):
+            await response.aclose()
+            self._invalidate_org_id()
+            yield {"type": "error", "content": "Unauthorized", "session_failed": True}
             return  # 停止生成器
         elif response.status_code != 200:
             # TODO: 处理错误
@@ -245,8 +340,12 @@ class ClaudeClient:
 
         # 处理流式响应
         # 使用 async for 迭代 _handle_response 生成器并 yield 其结果
-        async for event in self._handle_response(response, stream):
-            yield event
+        try:
+            async for event in self._handle_response(response, stream):
+                yield event
+        finally:
+            # 确保流式连接被释放回连接池，即使消费方提前中断
+            await response.aclose()
 
     async def _handle_response(
         self, response: curl_Response, stream: bool
@@ -261,87 +360,94 @@ class ClaudeClient:
             Dict[str, Any]: 包含事件类型和内容的字典
                 - type: "text", "thinking", "error", "done"
                 - content: 事件的具体内容 (文本、错误消息等)
+                - session_failed: 仅错误事件携带，表示上游或会话本身出错
         """
-        # 跟踪完整响应文本（用于非流式模式）
-        res_all_text = ""
-
-        async for line in response.aiter_lines():
-            # 确保line是字符串类型
-            if isinstance(line, bytes):
-                line = line.decode("utf-8")
+        # 非流式模式下收集文本片段，结束时一次性拼接
+        text_parts: List[str] = []
+        append_text = text_parts.append
+        # 流式模式下合并同一网络数据块中连续的同类增量，减少下游的事件和写入次数，
+        # 数据块处理完即输出，不会额外增加延迟
+        batch_type = ""
+        batch: List[str] = []
+
+        # curl_cffi 按字节返回数据，直接在字节上匹配前缀并交给 orjson 解析，无需解码
+        async for lines in _iter_sse_line_batches(response):
+            for line in lines:
+                # 忽略非数据行（切片比较比 startswith 方法调用更快）
+                if line[:SSE_DATA_PREFIX_LEN] != SSE_DATA_PREFIX:
+                    continue
 
-            # 忽略非数据行
-            if not line.startswith("data: "):
-                continue
+                data = line[SSE_DATA_PREFIX_LEN:]
+                # 忽略空的 data 行，以及既不是增量也不是错误的事件
+                if SSE_DELTA_MARKER not in data and SSE_ERROR_MARKER not in data:
+                    continue
 
-            data = line[6:]
-            # 忽略空的 data 行
-            if not data:
-                continue
+                try:
+                    event = orjson.loads(data)
+                except orjson.JSONDecodeError:
+                    logger.warning("解析 SSE 事件失败: {!r}", data)
+                    continue  # 继续处理下一行
 
-            try:
-                event = json.loads(data)
+                # 只读取一次事件类型和增量，按类型分支
+                event_type = event.get("type")
 
                 # 处理错误事件
-                if self._is_error_event(event):
-                    error_message = event["error"]["message"]
-                    yield {"type": "error", "content": error_message}  # Yield 错误事件
-                    return  # 发生错误后停止处理
-
-                # 处理文本增量
-                if self._is_text_delta(event):
-                    res_text = event["delta"]["text"]
-
-                    res_all_text += res_text
-                    if stream:
-                        yield {"type": "text", "content": res_text}  # Yield 文本事件
+                if event_type == "error":
+                    error_message = (event.get("error") or {}).get("message")
+                    if error_message is not None:
+                        if batch:
+                            yield {"type": batch_type, "content": "".join(batch)}
+                        # 上游返回的错误事件，标记为会话失败
+                        yield {
+                            "type": "error",
+                            "content": error_message,
+                            "session_failed": True,
+                        }
+                        return  # 发生错误后停止处理
                     continue
 
-                # 处理思考增量
-                if self._is_thinking_delta(event):
-                    res_text = event["delta"]["THINKING"]
+                # 其他事件（例如 completion 结束事件）没有增量，直接忽略，
+                # 流的结束由自定义的 "done" 事件标记
+                delta = event.get("delta")
+                if delta is None:
+                    continue
 
-                    res_all_text += res_text
-                    if stream:
-                        yield {
-                            "type": "thinking",
-                            "content": res_text,
-                        }  # Yield 思考事件
+                delta_type = delta.get("type")
+
+                # 处理文本增量和思考增量
+                if delta_type == "text_delta":
+                    res_type = "text"
+                    res_text = delta.get("text")
+                elif delta_type == "thinking_delta":
+                    res_type = "thinking"
+                    res_text = delta.get("THINKING")
+                else:
                     continue
 
-                # 处理其他可能的事件类型，例如 completion
-                if event.get("type") == "completion":
-                    # 这是一个结束事件，但我们使用自定义的 "done" 事件来标记流的结束
-                    pass  # 忽略 Claude 的 completion 事件，等待流结束
+                if res_text is None:
+                    continue
 
-            except json.JSONDecodeError:
-                logger.warning(f"解析 SSE 事件失败: {data}")
-                continue  # 继续处理下一行
+                if not stream:
+                    append_text(res_text)
+                    continue
+
+                # 增量类型变化时先输出已合并的内容，保持文本和思考的先后顺序
+                if batch and batch_type != res_type:
+                    yield {"type": batch_type, "content": "".join(batch)}
+                    batch = []
+                batch_type = res_type
+                batch.append(res_text)
+
+            # 当前数据块处理完毕，输出合并的增量
+            if batch:
+                yield {"type": batch_type, "content": "".join(batch)}  # Yield 增量事件
+                batch = []
 
         # 处理非流式响应或发送结束标记
         if not stream:
-            yield {"type": "text", "content": res_all_text}  # Yield 完整文本
+            yield {"type": "text", "content": "".join(text_parts)}  # Yield 完整文本
         yield {"type": "done"}  # Yield 完成事件
 
-    def _is_error_event(self, event: Dict[str, Any]) -> bool:
-        """检查是否为错误事件"""
-        return (
-            event.get("type") == "error"
-            and event.get("error", {}).get("message") is not None
-        )
-
-    def _is_text_delta(self, event: Dict[str, Any]) -> bool:
-        """检查是否为文本增量事件"""
-        delta = event.get("delta", {})
-        return delta.get("type") == "text_delta" and delta.get("text") is not None
-
-    def _is_thinking_delta(self, event: Dict[str, Any]) -> bool:
-        """检查是否为思考增量事件"""
-        delta = event.get("delta", {})
-        return (
-            delta.get("type") == "thinking_delta" and delta.get("THINKING") is not None
-        )
-
     async def delete_conversation(self, conversation_id: str) -> None:
         """删除会话
 
@@ -349,11 +455,8 @@ class ClaudeClient:
             conversation_id: 会话 ID
 
         Raises:
-            Exception: 未设置组织 ID 或删除失败时抛出
+            Exception: 删除失败时抛出
         """
-        if not self.org_id:
-            raise Exception("未设置组织 ID")
-
         url = f"{self.BASE_URL}/organizations/{self.org_id}/chat_conversations/{conversation_id}"
 
         request_body = {"uuid": conversation_id}
@@ -361,13 +464,18 @@ class ClaudeClient:
         try:
             response = await self.session.delete(
                 url,
-                json=request_body,
-                headers={"referer": f"https://claude.ai/chat/{conversation_id}"},
+                data=orjson.dumps(request_body),
+                headers=self._get_conversation_headers(conversation_id),
             )
 
+            # 会话已不存在，无需删除，也不应重试
+            if response.status_code in (404, 410):
+                logger.info("会话 {} 已不存在", conversation_id)
+                return
+
             if response.status_code not in (200, 204):
-                # 尝试读取错误信息
-                error_text = await response.text()
+                # 尝试读取错误信息（text 是属性，不可 await）
+                error_text = response.text
                 raise Exception(
                     f"删除会话失败，状态码: {response.status_code}, 响应: {error_text}"
                 )
@@ -376,150 +484,147 @@ class ClaudeClient:
             logger.error(f"删除会话失败: {e}")
             raise
 
-    async def upload_file(self, file_data: List[str]) -> None:
-        """上传文件到 Claude
+    async def upload_files(self, file_data: List[str]) -> None:
+        """并发上传多个文件到 Claude，并按原始顺序将文件 UUID 加入请求属性
 
         Args:
             file_data: 文件数据列表，格式为: data:image/jpeg;base64,/9j/4AA...
 
         Raises:
-            Exception: 当组织ID未设置、文件数据为空、数据格式无效或上传失败时抛出
+            Exception: 数据格式无效或任一文件上传失败时抛出
         """
-        if not self.org_id:
-            raise Exception("未设置组织 ID")
-
+        # 跳过空条目
+        file_data = [fd for fd in file_data if fd]
         if not file_data:
             # 文件数据为空不应抛出异常，只是没有文件需要上传
             logger.info("没有文件数据需要上传")
             return
 
-        # 确保files数组已初始化
-        if "files" not in self.request_attrs:
-            self.request_attrs["files"] = []
+        # 并发上传，总耗时约为单次往返而非 N 次往返；限制同时上传的数量，
+        # 避免大量图片同时占用共享会话的连接
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
 
-        # 处理每个文件
-        for fd in file_data:
-            if not fd:
-                continue  # 跳过空条目
+        async def upload(fd: str) -> str:
+            async with semaphore:
+                return await self.upload_file(fd)
 
-            # 解析base64数据
-            parts = fd.split(",", 1)
-            if len(parts) != 2:
-                raise Exception(f"文件数据格式无效: {fd[:50]}...")  # 避免打印整个数据
+        results = await asyncio.gather(
+            *(upload(fd) for fd in file_data), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
-            # 从数据URI获取内容类型
-            meta_parts = parts[0].split(":", 1)
-            if len(meta_parts) != 2:
-                raise Exception(f"文件数据中的内容类型无效: {parts[0]}")
+        self._extend_request_attr("files", results)
 
-            meta_info = meta_parts[1].split(";", 1)
-            if len(meta_info) != 2 or meta_info[1] != "base64":
-                raise Exception(f"文件数据中的编码无效: {meta_parts[1]}")
+    async def upload_file(self, file_data: str) -> str:
+        """上传单个文件到 Claude
 
-            content_type = meta_info[0]
+        Args:
+            file_data: 文件数据，格式为: data:image/jpeg;base64,/9j/4AA...
 
-            # 解码base64数据
-            try:
-                file_bytes = base64.b64decode(parts[1])
-            except Exception as e:
-                raise Exception(f"解码base64数据失败: {e}")
-
-            # 根据内容类型确定文件名
-            filename = "file"
-            if content_type == "image/jpeg":
-                filename = "image.jpg"
-            elif content_type == "image/png":
-                filename = "image.png"
-            elif content_type == "application/pdf":
-                filename = "document.pdf"
-            # 可以根据需要添加更多文件类型
-
-            # 创建上传URL - 注意这里修改了URL格式以匹配Golang实现
-            url = f"{self.BASE_URL}/{self.org_id}/upload"
-            logger.debug(f"上传URL: {url}")
+        Returns:
+            str: 上传后的文件 UUID
 
-            try:
-                # 使用curl_cffi的CurlMime创建multipart/form-data请求
-                from curl_cffi import CurlMime
+        Raises:
+            Exception: 数据格式无效或上传失败时抛出
+        """
+        # 解析数据URI: data:<content_type>;base64,<payload>
+        header, sep, payload = file_data.partition(",")
+        if not sep:
+            raise Exception(f"文件数据格式无效: {file_data[:50]}...")  # 避免打印整个数据
 
-                logger.debug(
-                    f"准备上传文件: {filename}, 类型: {content_type}, 大小: {len(file_bytes)} 字节"
-                )
+        if not header.startswith("data:"):
+            raise Exception(f"文件数据中的内容类型无效: {header}")
 
-                # 创建multipart表单
-                mp = CurlMime()
-                mp.addpart(
-                    name="file",
-                    content_type=content_type,
-                    filename=filename,
-                    data=file_bytes,
-                )
+        if not header.endswith(";base64"):
+            raise Exception(f"文件数据中的编码无效: {header[5:]}")
 
-                # 准备请求头
-                headers = {
-                    "referer": "https://claude.ai/new",
-                    "anthropic-client-platform": "web_claude_ai",
-                    "content-type": "multipart/form-data",  # fix upload file error bug
-                }
+        content_type = header[5:-7]
+
+        # 解码base64数据
+        try:
+            file_bytes = base64.b64decode(payload)
+        except Exception as e:
+            raise Exception(f"解码base64数据失败: {e}")
 
-                logger.debug(f"发送上传请求到: {url}")
+        # 根据内容类型确定文件名
+        filename = UPLOAD_FILENAMES.get(content_type, "file")
 
+        # 创建上传URL - 注意这里修改了URL格式以匹配Golang实现
+        url = f"{self.BASE_URL}/{self.org_id}/upload"
+        logger.debug("上传URL: {}", url)
+
+        try:
+            logger.debug(
+                "准备上传文件: {}, 类型: {}, 大小: {} 字节",
+                filename,
+                content_type,
+                len(file_bytes),
+            )
+
+            # 使用curl_cffi的CurlMime创建multipart/form-data请求
+            mp = CurlMime()
+            mp.addpart(
+                name="file",
+                content_type=content_type,
+                filename=filename,
+                data=file_bytes,
+            )
+
+            logger.debug("发送上传请求到: {}", url)
+
+            try:
                 # 发送请求
                 response: curl_Response = await self.session.post(
                     url,
                     multipart=mp,  # 使用multipart参数而不是files
-                    headers=headers,
+                    headers=self.UPLOAD_HEADERS,
                 )
-
+            finally:
                 # 关闭multipart表单以释放资源
                 mp.close()
 
-                logger.debug(f"收到响应，状态码: {response.status_code}")
+            logger.debug("收到响应，状态码: {}", response.status_code)
 
-                # 处理非200响应
-                if response.status_code != 200:
-                    try:
-                        error_data = response.json()
-                        error_text = f"错误消息: {error_data}"
-                    except Exception:
-                        error_text = (
-                            response.text if hasattr(response, "text") else "无响应内容"
-                        )
-
-                    logger.error(
-                        f"上传失败，状态码: {response.status_code}，响应: {error_text}"
-                    )
-                    raise Exception(
-                        f"上传失败，状态码: {response.status_code}，响应: {error_text}"
+            # 处理非200响应
+            if response.status_code != 200:
+                try:
+                    error_data = response.json()
+                    error_text = f"错误消息: {error_data}"
+                except Exception:
+                    error_text = (
+                        response.text if hasattr(response, "text") else "无响应内容"
                     )
 
-                # 解析响应
-                try:
-                    result: dict = response.json()
-                    logger.debug(f"响应数据: {result}")
-                    file_uuid: str = result.get("file_uuid", "")
-
-                    if not file_uuid:
-                        logger.error("响应中未找到文件UUID")
-                        raise Exception("响应中未找到文件UUID")
-                except Exception as e:
-                    logger.error(f"解析响应失败: {e}")
-                    raise Exception(f"解析响应失败: {e}")
-
-                # 将文件添加到默认属性
-                # 确保 self.request_attrs["files"] 是列表
-                if "files" not in self.request_attrs or not isinstance(
-                    self.request_attrs["files"], list
-                ):
-                    self.request_attrs["files"] = []
-                self.request_attrs["files"].append(file_uuid)  # type: ignore
-                logger.info(
-                    f"文件 {filename} ({content_type}) 上传成功，UUID: {file_uuid}"
+                logger.error(
+                    f"上传失败，状态码: {response.status_code}，响应: {error_text}"
+                )
+                raise Exception(
+                    f"上传失败，状态码: {response.status_code}，响应: {error_text}"
                 )
 
+            # 解析响应
+            try:
+                result: dict = response.json()
+                logger.debug("响应数据: {}", result)
+                file_uuid: str = result.get("file_uuid", "")
+
+                if not file_uuid:
+                    logger.error("响应中未找到文件UUID")
+                    raise Exception("响应中未找到文件UUID")
             except Exception as e:
-                logger.error(f"上传文件失败: {e}")
-                raise
+                logger.error(f"解析响应失败: {e}")
+                raise Exception(f"解析响应失败: {e}")
+
+            logger.info(
+                "文件 {} ({}) 上传成功，UUID: {}", filename, content_type, file_uuid
+            )
+            return file_uuid
+
+        except Exception as e:
+            logger.error(f"上传文件失败: {e}")
+            raise
 
     def set_big_context(self, context: str) -> None:
         """设置大型上下文
@@ -527,32 +632,102 @@ class ClaudeClient:
         Args:
             context: 上下文内容
         """
-        # 确保 attachments 数组已初始化
-        if "attachments" not in self.request_attrs or not isinstance(
-            self.request_attrs["attachments"], list
-        ):
-            self.request_attrs["attachments"] = []
-
-        self.request_attrs["attachments"].append(  # type: ignore
-            {
-                "file_name": "context.txt",
-                "file_type": "text/plain",
-                "file_size": len(context),
-                "extracted_content": context,
-            }
+        self._extend_request_attr(
+            "attachments",
+            [
+                {
+                    "file_name": "context.txt",
+                    "file_type": "text/plain",
+                    "file_size": len(context),
+                    "extracted_content": context,
+                }
+            ],
         )
         logger.info("大型上下文已添加到请求属性中")
 
+    def _extend_request_attr(self, key: str, items: List[Any]) -> None:
+        """向请求属性中的列表追加元素
+
+        首次修改时才复制 DEFAULT_ATTRS，且列表总是重新赋值而非原地 append，
+        避免修改共享的默认属性。
+
+        Args:
+            key: 请求属性名（"files" 或 "attachments"）
+            items: 要追加的元素
+        """
+        if self.request_attrs is self.DEFAULT_ATTRS:
+            self.request_attrs = self.DEFAULT_ATTRS.copy()
+        current = self.request_attrs.get(key)
+        if not isinstance(current, list):
+            current = []
+        self.request_attrs[key] = [*current, *items]
+        self._body_prefix = None
+
+
+async def _iter_sse_line_batches(
+    response: curl_Response,
+) -> AsyncGenerator[List[bytes], None]:
+    """按网络数据块读取 SSE 响应，每次产出一个数据块中的所有完整行
+
+    跨数据块的不完整行会保留到下一个数据块拼接。
 
-async def new_client(session_key: str, proxy: str = "") -> ClaudeClient:
-    """创建新的 Claude 客户端
+    Args:
+        response: curl_cffi 流式响应对象
+
+    Yields:
+        List[bytes]: 完整的行（不含换行符，可能带有结尾的 \r）
+    """
+    pending = b""
+    async for chunk in response.aiter_content():
+        lines = (pending + chunk).split(b"\n") if pending else chunk.split(b"\n")
+        pending = lines.pop()
+        if lines:
+            yield lines
+    if pending:
+        yield [pending]
+
+
+def _serialize_body_prefix(attrs: Dict[str, Any]) -> bytes:
+    """序列化请求属性，得到以 ,"prompt": 结尾的请求体前缀
+
+    Args:
+        attrs: 请求属性（非空）
+
+    Returns:
+        bytes: 请求体前缀，追加 JSON 编码的 prompt 和 } 即为完整请求体
+    """
+    return orjson.dumps(attrs)[:-1] + b',"prompt":'
+
+
+# 默认请求属性不变，其请求体前缀只需序列化一次
+_DEFAULT_BODY_PREFIX = _serialize_body_prefix(ClaudeClient.DEFAULT_ATTRS)
+
+
+async def close_sessions() -> None:
+    """关闭所有共享的 curl_cffi 会话，用于服务关闭时"""
+    sessions = list(_SESSION_POOL.values())
+    _SESSION_POOL.clear()
+    for session in sessions:
+        await session.close()
+
+
+async def new_client(
+    session_key: str, proxy: str = "", org_id: str = ""
+) -> ClaudeClient:
+    """创建新的 Claude 客户端，返回的客户端总是已设置组织 ID
 
     Args:
         session_key: Claude 会话密钥
         proxy: 代理服务器地址
+        org_id: 已知的组织 ID，为空时自动获取
 
     Returns:
         ClaudeClient: Claude 客户端实例
+
+    Raises:
+        Exception: 获取组织 ID 失败时抛出
     """
-    client = ClaudeClient(session_key, proxy)
+    client = ClaudeClient(session_key, proxy, org_id)
+    if not org_id:
+        client.org_id = await client.get_org_id()
     return client
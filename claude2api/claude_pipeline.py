@@ -2,15 +2,21 @@
 Claude管道模块，负责协调消息处理、上下文管理和会话管理，生成响应。
 """
 
-from typing import Dict, Any, AsyncGenerator
+import asyncio
+from contextlib import aclosing
+from typing import Dict, Any, AsyncGenerator, List, Optional, Tuple, Union
 
-from claude2api.config import SessionInfo
+from claude2api.config import get_config, SessionInfo
 from claude2api.models import ChatCompletionRequest
 from claude2api.message_processor import MessageProcessor
 from claude2api.context_manager import ContextManager
 from claude2api.conversation_manager import ConversationManager
 
 
+# 消息数超过该值时在线程池中构建提示，避免长对话阻塞事件循环
+PROMPT_THREAD_THRESHOLD = 32
+
+
 class ClaudePipeline:
     """Claude处理管道，负责处理用户请求并通过Claude API生成响应"""
 
@@ -19,26 +25,68 @@ class ClaudePipeline:
         self.message_processor = MessageProcessor()
         self.context_manager = ContextManager()
         self.conversation_manager = ConversationManager()
+        # 限制同时进行的上游请求数，避免突发流量下内存无限增长
+        self.upstream_semaphore = asyncio.Semaphore(
+            get_config().upstream_concurrency
+        )
+
+    async def build_prompt(
+        self, request: ChatCompletionRequest
+    ) -> Tuple[str, List[str]]:
+        """将请求消息转换为提示文本和图片数据列表
+
+        结果与会话无关，重试时可直接复用。消息较多时在线程池中处理，
+        较短的对话直接处理以免线程切换的开销。
+
+        Args:
+            request: 聊天请求对象
+
+        Returns:
+            Tuple[str, List[str]]: 提示文本和图片数据列表
+        """
+        messages = request.messages
+        if len(messages) > PROMPT_THREAD_THRESHOLD:
+            return await asyncio.to_thread(
+                self.message_processor.process_messages, messages
+            )
+        return self.message_processor.process_messages(messages)
 
     async def pipline(
-        self, request: ChatCompletionRequest, session: SessionInfo
+        self,
+        request: ChatCompletionRequest,
+        session: SessionInfo,
+        prompt: str,
+        image_data: List[str],
     ) -> AsyncGenerator[Dict[str, Any], None]:
         """处理聊天请求并生成响应流
 
         Args:
             request: 聊天请求对象
             session: 会话信息对象
+            prompt: 由 build_prompt 构建的提示文本
+            image_data: 由 build_prompt 提取的图片数据列表
 
         Yields:
             Dict[str, Any]: 包含响应类型和内容的字典
               - type: "text", "thinking", "error", "done"
               - content: 事件的具体内容
+              - session_failed: 仅错误事件携带，为真时表示上游或会话本身出错，
+                由请求内容引起的错误（如图片无效）不携带该标记
         """
-        # 处理消息
-        self.message_processor.process_messages(request.messages)
-        prompt = self.message_processor.get_prompt()
-        image_data = self.message_processor.get_image_data()
-
+        async with self.upstream_semaphore, aclosing(
+            self._pipline(request, session, prompt, image_data)
+        ) as events:
+            async for event in events:
+                yield event
+
+    async def _pipline(
+        self,
+        request: ChatCompletionRequest,
+        session: SessionInfo,
+        prompt: str,
+        image_data: List[str],
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """处理聊天请求并生成响应流（不受并发限制）"""
         # 初始化变量
         conversation_id = None
         client = None
@@ -48,17 +96,9 @@ class ClaudePipeline:
             try:
                 client = await self.conversation_manager.create_client(session)
             except Exception as e:
-                yield {"type": "error", "content": str(e)}
+                yield {"type": "error", "content": str(e), "session_failed": True}
                 return
 
-            # 上传图片文件（如果有）
-            if image_data:
-                try:
-                    await self.context_manager.upload_images(client, image_data)
-                except Exception as e:
-                    yield {"type": "error", "content": str(e)}
-                    return
-
             # 处理大型上下文
             try:
                 prompt = await self.context_manager.handle_large_context(client, prompt)
@@ -66,14 +106,41 @@ class ClaudePipeline:
                 yield {"type": "error", "content": str(e)}
                 return
 
-            # 创建会话
-            try:
-                conversation_id = await self.conversation_manager.create_conversation(
-                    client, request.model
+            if image_data:
+                # 上传图片和创建会话都只依赖组织 ID，二者并发进行以节省一次往返
+                upload_result: Optional[BaseException]
+                conversation_result: Union[str, BaseException]
+                upload_result, conversation_result = await asyncio.gather(
+                    self.context_manager.upload_images(client, image_data),
+                    self.conversation_manager.create_conversation(
+                        client, request.model
+                    ),
+                    return_exceptions=True,
                 )
-            except Exception as e:
-                yield {"type": "error", "content": str(e)}
-                return
+                # 会话创建成功时先记录会话 ID，即使上传失败也能在 finally 中清理
+                if not isinstance(conversation_result, BaseException):
+                    conversation_id = conversation_result
+                if isinstance(upload_result, BaseException):
+                    yield {"type": "error", "content": str(upload_result)}
+                    return
+                if isinstance(conversation_result, BaseException):
+                    yield {
+                        "type": "error",
+                        "content": str(conversation_result),
+                        "session_failed": True,
+                    }
+                    return
+            else:
+                # 创建会话
+                try:
+                    conversation_id = (
+                        await self.conversation_manager.create_conversation(
+                            client, request.model
+                        )
+                    )
+                except Exception as e:
+                    yield {"type": "error", "content": str(e), "session_failed": True}
+                    return
 
             # 发送消息并处理响应流
             try:
@@ -82,8 +149,9 @@ class ClaudePipeline:
                 )
 
                 # 转发来自Claude客户端的事件
-                async for event in message_generator:
-                    yield event
+                async with aclosing(message_generator):
+                    async for event in message_generator:
+                        yield event
 
             except Exception as e:
                 yield {"type": "error", "content": f"处理响应时发生内部错误: {e}"}
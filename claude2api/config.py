@@ -1,79 +1,123 @@
-from loguru import logger
+import dataclasses
+import functools
 import yaml
 import threading
 from pathlib import Path
 import os
-from typing import List, Optional
-from pydantic import BaseModel, Field, field_validator, ConfigDict
-
-
-class SessionInfo(BaseModel):
-    """会话信息模型"""
+from typing import Any, Dict, List, Optional
+from loguru import logger
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    PrivateAttr,
+    ValidationInfo,
+    field_validator,
+)
+
+# 优先使用基于 libyaml 的 C 加载器，不可用时回退到纯 Python 实现
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader  # type: ignore[assignment]
+
+
+@dataclasses.dataclass(slots=True)
+class SessionInfo:
+    """会话信息，作为 ClaudeConfig 字段时仍由 pydantic 校验"""
 
     session_key: str
     org_id: str = ""
 
 
-class SessionRange:
-    """会话索引范围管理器"""
-
-    def __init__(self):
-        self.index = 0
-        self.mutex = threading.Lock()
-
-    def next_index(self, sessions_count: int) -> int:
-        """获取下一个会话索引"""
-        with self.mutex:
-            index = self.index
-            self.index = (index + 1) % sessions_count if sessions_count > 0 else 0
-            return index
-
-
 class ClaudeConfig(BaseModel):
     """Claude配置模型"""
 
-    model_config = ConfigDict(arbitrary_types_allowed=True)
+    # 配置在加载后不可修改；会话的组织ID由 set_session_org_id 单独维护
+    model_config = ConfigDict(frozen=True)
 
     sessions: List[SessionInfo] = Field(default_factory=list)
     address: str = "0.0.0.0:8000"
+    workers: int = 4
+    limit_concurrency: int = 512
+    upstream_concurrency: int = 64
     api_key: str = ""
+    cors_origins: List[str] = Field(default_factory=lambda: ["*"])
     proxy: str = ""
     chat_delete: bool = True
     max_chat_history_length: int = 10000
-    retry_count: int = 0
+    max_request_body_size: int = 20 * 1024 * 1024
+    retry_count: int = Field(default=0, validate_default=True)
+    session_cooldown: float = 30
     no_role_prefix: bool = False
     prompt_disable_artifacts: bool = False
 
+    _session_index: Dict[str, SessionInfo] = PrivateAttr(default_factory=dict)
+    # 保护会话组织ID的更新
+    _org_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @field_validator("sessions")
+    def dedupe_sessions(cls, v: List[SessionInfo]) -> List[SessionInfo]:
+        # 同一会话密钥只保留第一次出现的配置
+        unique: Dict[str, SessionInfo] = {}
+        for session in v:
+            unique.setdefault(session.session_key, session)
+        return list(unique.values())
+
     @field_validator("address")
     def validate_address(cls, v: str) -> str:
         if ":" not in v:
             raise ValueError("address必须包含端口号，格式示例：0.0.0.0:8000")
-        host, port = v.split(":", 1)
-        return f"{host}:{port}"
+        return v
+
+    @field_validator("retry_count")
+    def default_retry_count(cls, v: int, info: ValidationInfo) -> int:
+        # 如果没有设置重试次数，设置为会话数量，但不超过5
+        if v == 0:
+            return min(len(info.data.get("sessions", [])), 5)
+        return v
 
-    def get_session_for_model(self, idx: int) -> Optional[SessionInfo]:
-        """获取指定索引的会话信息"""
-        if not self.sessions or idx < 0 or idx >= len(self.sessions):
-            return None
-        return self.sessions[idx]
+    def model_post_init(self, __context: Any) -> None:
+        self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        """建立会话密钥到会话的索引，按密钥查找会话时无需线性扫描
+
+        原地修改 sessions 列表后需要调用此方法
+        """
+        self._session_index = {
+            session.session_key: session for session in self.sessions
+        }
 
     def set_session_org_id(self, session_key: str, org_id: str) -> None:
         """设置指定会话的组织ID"""
-        for i, session in enumerate(self.sessions):
-            if session.session_key == session_key:
-                print(f"Setting OrgID for session {session_key} to {org_id}")
-                self.sessions[i].org_id = org_id
-                return
+        with self._org_lock:
+            session = self._session_index.get(session_key)
+            # 并发创建客户端时可能重复设置同一值，跳过无变化的写入
+            if session is not None and session.org_id != org_id:
+                logger.debug("为会话 {} 设置组织 ID: {}", _mask(session_key), org_id)
+                session.org_id = org_id
+
+    def clear_session_org_id(self, session_key: str) -> None:
+        """清除指定会话的组织ID，下次创建客户端时重新获取"""
+        with self._org_lock:
+            session = self._session_index.get(session_key)
+            if session is not None:
+                session.org_id = ""
+
 
+# 可执行文件目录，在导入时计算一次
+EXEC_DIR = Path(os.path.dirname(os.path.abspath(__file__))).parent
 
+
+@functools.lru_cache(maxsize=None)
 def find_config_file() -> Optional[str]:
-    """查找配置文件路径"""
-    # 获取可执行文件目录和工作目录
-    exec_dir = Path(os.path.dirname(os.path.abspath(__file__))).parent
+    """查找配置文件路径，结果在首次查找后缓存"""
+    # 获取工作目录
     work_dir = Path.cwd()
 
     # 检查可执行文件目录中的配置
-    exe_config_path = exec_dir / "config.yaml"
+    exe_config_path = EXEC_DIR / "config.yaml"
     if exe_config_path.exists():
         return str(exe_config_path)
 
@@ -88,37 +132,58 @@ def find_config_file() -> Optional[str]:
 def load_config_from_yaml(config_path: str) -> dict:
     """从YAML文件加载配置"""
     try:
-        with open(config_path, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f) or {}
+        # 以字节读取，由 libyaml 自行完成 UTF-8 解码
+        with open(config_path, "rb") as f:
+            return yaml.load(f, Loader=YamlLoader) or {}
     except Exception as e:
-        print(f"从YAML加载配置失败: {e}")
+        logger.error("从YAML加载配置失败: {}", e)
         return {}
 
 
+def _mask(secret: str) -> str:
+    """遮盖密钥，只保留末尾 6 个字符用于区分会话
+
+    会话密钥都以相同的 sk-ant-sid01- 开头，保留前缀无法区分，因此保留后缀。
+    过短的密钥完全遮盖。
+    """
+    if not secret:
+        return ""
+    return "…" + secret[-6:] if len(secret) > 12 else "…"
+
+
 class Config:
     """全局配置单例类"""
 
     _instance = None
     _initialized = False
+    # 保护单例创建和初始化，避免多个线程重复加载配置
+    _lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
-            cls._instance = super(Config, cls).__new__(cls)
+            with cls._lock:
+                if cls._instance is None:
+                    instance = super(Config, cls).__new__(cls)
+                    instance.config_model = None
+                    cls._instance = instance
         return cls._instance
 
-    def __init__(self):
-        if Config._initialized:
-            return
-
-        self.config_model = None
-        self.session_range = SessionRange()
-        Config._initialized = False
-
     def initialize(self, config_path: str = "") -> ClaudeConfig:
         """初始化配置"""
         if Config._initialized:
             return self.config_model
 
+        with Config._lock:
+            # 双重检查，其他线程可能已在等待锁期间完成初始化
+            if not Config._initialized:
+                self._load(config_path)
+                # 配置模型完全赋值后才标记为已初始化
+                Config._initialized = True
+
+        return self.config_model
+
+    def _load(self, config_path: str) -> None:
+        """加载配置文件并创建配置模型"""
         # 加载配置文件
         config_data = {}
 
@@ -129,44 +194,47 @@ class Config:
             # 自动查找配置文件
             found_path = find_config_file()
             if found_path:
-                print(f"在 {found_path} 找到配置文件")
+                logger.info("在 {} 找到配置文件", found_path)
                 config_data = load_config_from_yaml(found_path)
 
         # 创建配置模型
         self.config_model = ClaudeConfig(**config_data)
 
-        # 如果没有设置重试次数，设置为会话数量，但不超过5
-        if self.config_model.retry_count == 0 and self.config_model.sessions:
-            self.config_model.retry_count = min(len(self.config_model.sessions), 5)
-
         # 打印配置信息
         self._log_config()
 
-        Config._initialized = True
-        return self.config_model
-
     def _log_config(self):
-        """记录配置信息"""
-        print("已加载配置:")
-        print(f"最大重试次数: {self.config_model.retry_count}")
-        for session in self.config_model.sessions:
-            print(f"会话: {session.session_key}, 组织ID: {session.org_id}")
-        print(f"地址: {self.config_model.address}")
-        print(f"APIKey: {'已设置' if self.config_model.api_key else '未设置'}")
-        print(f"代理: {self.config_model.proxy}")
-        print(f"聊天删除: {self.config_model.chat_delete}")
-        print(f"最大聊天历史长度: {self.config_model.max_chat_history_length}")
-        print(f"无角色前缀: {self.config_model.no_role_prefix}")
-        print(f"提示词禁用artifacts: {self.config_model.prompt_disable_artifacts}")
-
-    def get_next_session(self) -> SessionInfo:
-        """获取下一个会话信息"""
-        if not self.config_model or not self.config_model.sessions:
-            logger.error("config session 字段错误")
-            raise ValueError("config session 字段错误")
-
-        idx = self.session_range.next_index(len(self.config_model.sessions))
-        return self.config_model.get_session_for_model(idx)
+        """记录配置信息，低于 INFO 级别时不会格式化"""
+        logger.opt(lazy=True).info("已加载配置:\n{}", self._format_config)
+
+    def _format_config(self) -> str:
+        """格式化配置信息，会话密钥只显示前缀"""
+        config = self.config_model
+        lines = [
+            f"最大重试次数: {config.retry_count}",
+            f"失败会话冷却时间: {config.session_cooldown}",
+        ]
+        lines.extend(
+            f"会话: {_mask(session.session_key)}, 组织ID: {session.org_id}"
+            for session in config.sessions
+        )
+        lines.extend(
+            (
+                f"地址: {config.address}",
+                f"工作进程数: {config.workers}",
+                f"最大并发连接数: {config.limit_concurrency}",
+                f"上游最大并发请求数: {config.upstream_concurrency}",
+                f"APIKey: {'已设置' if config.api_key else '未设置'}",
+                f"代理: {config.proxy}",
+                f"CORS 允许来源: {config.cors_origins}",
+                f"聊天删除: {config.chat_delete}",
+                f"最大聊天历史长度: {config.max_chat_history_length}",
+                f"最大请求体大小: {config.max_request_body_size}",
+                f"无角色前缀: {config.no_role_prefix}",
+                f"提示词禁用artifacts: {config.prompt_disable_artifacts}",
+            )
+        )
+        return "\n".join(lines)
 
     @property
     def claude_config(self) -> ClaudeConfig:
@@ -180,11 +248,6 @@ def get_config() -> ClaudeConfig:
     return Config().claude_config
 
 
-def get_next_session() -> SessionInfo:
-    """获取下一个会话信息"""
-    return Config().get_next_session()
-
-
 def initialize(config_path: str = "") -> ClaudeConfig:
     """初始化配置"""
     return Config().initialize(config_path)
@@ -7,14 +7,26 @@ from loguru import logger
 
 from claude2api.config import get_config
 from claude2api.claude_client import ClaudeClient
+from claude2api.message_processor import ARTIFACTS_DISABLED_HEADER
+
+
+# 获取配置实例
+config_instance = get_config()
 
 
 class ContextManager:
     """上下文管理器，负责处理大型上下文和图片附件"""
 
+    __slots__ = ("config", "_max_len", "_disable_artifacts", "_big_context_prompt")
+
     def __init__(self):
         """初始化上下文管理器"""
-        self.config = get_config()
+        self.config = config_instance
+        # 配置加载后不可变，预先取出每个请求都要读取的配置项
+        self._max_len = self.config.max_chat_history_length
+        self._disable_artifacts = self.config.prompt_disable_artifacts
+        # 替代提示只取决于上述配置，构建一次即可
+        self._big_context_prompt = self._build_big_context_prompt()
 
     def is_large_context(self, prompt: str) -> bool:
         """检查是否为大型上下文
@@ -25,22 +37,27 @@ class ContextManager:
         Returns:
             bool: 是否为大型上下文
         """
-        return len(prompt) > self.config.max_chat_history_length
+        return len(prompt) > self._max_len
 
     def get_big_context_prompt(self) -> str:
         """获取大型上下文的替代提示
 
+        Returns:
+            str: 大型上下文的替代提示
+        """
+        return self._big_context_prompt
+
+    def _build_big_context_prompt(self) -> str:
+        """构建大型上下文的替代提示
+
         Returns:
             str: 大型上下文的替代提示
         """
         prompt = ""
 
         # 如果配置禁用了 artifacts
-        if (
-            hasattr(self.config, "prompt_disable_artifacts")
-            and self.config.prompt_disable_artifacts
-        ):
-            prompt += "System: Forbidden to use <antArtifac> </antArtifac> to wrap code blocks, use markdown syntax instead, which means wrapping code blocks with ``` ```\n\n"
+        if self._disable_artifacts:
+            prompt += ARTIFACTS_DISABLED_HEADER
 
         prompt += "You must immerse yourself in the role of assistant in context.txt, cannot respond as a user, cannot reply to this message, cannot mention this message, and ignore this message in your response.\n\n"
 
@@ -66,7 +83,7 @@ class ContextManager:
             client.set_big_context(prompt)
             new_prompt = self.get_big_context_prompt()
             logger.info(
-                f"提示长度超过最大限制 ({self.config.max_chat_history_length})，使用文件上下文"
+                f"提示长度超过最大限制 ({self._max_len})，使用文件上下文"
             )
             return new_prompt
         except Exception as e:
@@ -87,8 +104,8 @@ class ContextManager:
             return
 
         try:
-            await client.upload_file(image_data)
-            logger.info(f"成功上传 {len(image_data)} 个文件")
+            await client.upload_files(image_data)
+            logger.info("成功上传 {} 个文件", len(image_data))
         except Exception as e:
             logger.error(f"上传文件失败: {e}")
             raise Exception(f"上传文件失败: {e}")
@@ -3,18 +3,39 @@
 """
 
 import asyncio
+import random
+from typing import List, Optional, Tuple
 from loguru import logger
 
 from claude2api.config import get_config, SessionInfo
 from claude2api.claude_client import ClaudeClient, new_client
 
 
+# 获取配置实例
+config_instance = get_config()
+
+# 单次删除请求的超时时间（秒）及重试退避的上限（秒）
+CLEANUP_TIMEOUT = 5
+CLEANUP_MAX_BACKOFF = 30
+# 待清理会话队列的容量，队列满时丢弃新的清理请求
+CLEANUP_QUEUE_SIZE = 1024
+# 清理工作协程每批最多并发处理的会话数
+CLEANUP_BATCH_SIZE = 16
+
+
 class ConversationManager:
     """会话管理器，负责会话的创建、管理和清理"""
 
+    __slots__ = ("config", "_cleanup_queue", "_cleanup_worker")
+
     def __init__(self):
         """初始化会话管理器"""
-        self.config = get_config()
+        self.config = config_instance
+        # 待清理的 (客户端, 会话ID)，由单个后台工作协程消费，工作协程在首次清理时启动
+        self._cleanup_queue: asyncio.Queue[Tuple[ClaudeClient, str]] = asyncio.Queue(
+            maxsize=CLEANUP_QUEUE_SIZE
+        )
+        self._cleanup_worker: Optional[asyncio.Task] = None
 
     async def create_client(self, session: SessionInfo) -> ClaudeClient:
         """创建Claude客户端
@@ -28,21 +49,20 @@ class ConversationManager:
         Raises:
             Exception: 获取组织ID失败时抛出
         """
-        # 初始化 Claude 客户端
-        client = await new_client(session.session_key, self.config.proxy)
+        # 初始化 Claude 客户端，没有组织 ID 时由 new_client 获取
+        try:
+            client = await new_client(
+                session.session_key, self.config.proxy, session.org_id
+            )
+        except Exception as e:
+            logger.error(f"获取组织 ID 失败: {e}")
+            raise Exception(f"获取组织 ID 失败: {e}")
 
-        # 如果没有组织 ID，则获取
         if not session.org_id:
-            try:
-                org_id = await client.get_org_id()
-                session.org_id = org_id
-                self.config.set_session_org_id(session.session_key, session.org_id)
-                logger.info(f"成功获取并设置组织 ID: {org_id}")
-            except Exception as e:
-                logger.error(f"获取组织 ID 失败: {e}")
-                raise Exception(f"获取组织 ID 失败: {e}")
+            session.org_id = client.org_id
+            self.config.set_session_org_id(session.session_key, session.org_id)
+            logger.info(f"成功获取并设置组织 ID: {client.org_id}")
 
-        client.set_org_id(session.org_id)
         return client
 
     async def create_conversation(self, client: ClaudeClient, model: str) -> str:
@@ -60,7 +80,7 @@ class ConversationManager:
         """
         try:
             conversation_id = await client.create_conversation(model)
-            logger.info(f"成功创建会话: {conversation_id}")
+            logger.info("成功创建会话: {}", conversation_id)
             return conversation_id
         except Exception as e:
             logger.error(f"创建会话失败: {e}")
@@ -78,15 +98,52 @@ class ConversationManager:
         if not self.config.chat_delete:
             return
 
-        # 使用 create_task 调度清理，不阻塞当前函数返回
-        asyncio.create_task(self._cleanup_conversation_task(client, conversation_id, 3))
-        logger.info(f"已调度会话 {conversation_id} 的清理任务")
+        # 放入队列由后台工作协程处理，不阻塞当前函数返回
+        if self._cleanup_worker is None or self._cleanup_worker.done():
+            self._cleanup_worker = asyncio.create_task(self._run_cleanup_worker())
+        try:
+            self._cleanup_queue.put_nowait((client, conversation_id))
+        except asyncio.QueueFull:
+            logger.warning(f"清理队列已满，放弃清理会话 {conversation_id}")
+            return
+        logger.info("已调度会话 {} 的清理任务", conversation_id)
+
+    async def wait_for_cleanup(self) -> None:
+        """等待队列中的清理任务全部完成并停止工作协程，用于服务关闭时"""
+        if self._cleanup_worker is None:
+            return
+        if not self._cleanup_worker.done():
+            await self._cleanup_queue.join()
+        self._cleanup_worker.cancel()
+        self._cleanup_worker = None
+
+    async def _run_cleanup_worker(self) -> None:
+        """清理工作协程，每次取出一批待清理会话并发删除"""
+        queue = self._cleanup_queue
+        while True:
+            batch: List[Tuple[ClaudeClient, str]] = [await queue.get()]
+            while len(batch) < CLEANUP_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            try:
+                await asyncio.gather(
+                    *(
+                        self._cleanup_conversation_task(client, conversation_id, 3)
+                        for client, conversation_id in batch
+                    ),
+                    return_exceptions=True,
+                )
+            finally:
+                for _ in batch:
+                    queue.task_done()
 
     async def _cleanup_conversation_task(
         self, client: ClaudeClient, conversation_id: str, retry: int
     ) -> None:
         """清理会话任务
 
+        每次删除请求都有超时限制，失败后按指数退避加随机抖动重试。
+
         Args:
             client: Claude客户端
             conversation_id: 会话ID
@@ -94,12 +151,18 @@ class ConversationManager:
         """
         for i in range(retry):
             try:
-                await client.delete_conversation(conversation_id)
-                logger.info(f"成功删除会话: {conversation_id}")
+                await asyncio.wait_for(
+                    client.delete_conversation(conversation_id),
+                    timeout=CLEANUP_TIMEOUT,
+                )
+                logger.info("成功删除会话: {}", conversation_id)
                 return
             except Exception as e:
-                logger.error(f"删除会话失败 (重试 {i + 1}/{retry}): {e}")
-                await asyncio.sleep(2)
+                logger.error(f"删除会话失败 (重试 {i + 1}/{retry}): {e!r}")
+                if i + 1 < retry:
+                    await asyncio.sleep(
+                        min(CLEANUP_MAX_BACKOFF, 2**i) + random.random()
+                    )
 
         # 当所有重试都失败后执行
         logger.error(f"清理会话 {conversation_id} 在 {retry} 次重试后失败")
@@ -1,34 +1,73 @@
+import asyncio
+import time
+import uuid
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Dict, List
+import orjson
 from loguru import logger
-from fastapi import Request, Depends, HTTPException
-from fastapi.responses import StreamingResponse
-from claude2api.config import get_config, get_next_session
-from claude2api.auth import verify_token
-from claude2api.models import (
-    ChatCompletionRequest,
-    OpenAIStreamResponse,
-    OpenAIResponse,
-    StreamChoice,
-    NoStreamChoice,
-    Message,
-    Usage,
-    Delta,
-)
+from fastapi import Request, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from pydantic import TypeAdapter
+from claude2api.config import _mask, get_config
+from claude2api.session_pool import session_pool
+from claude2api.models import ChatCompletionRequest
 from claude2api.claude_pipeline import claude_pipeline
 
 # 获取配置实例
 config_instance = get_config()
 
+# 请求校验器在导入时构建一次，避免每次请求重复构建
+_REQUEST_ADAPTER = TypeAdapter(ChatCompletionRequest)
+
+# SSE 数据帧的固定部分
+SSE_DATA_PREFIX = b"data: "
+SSE_FRAME_END = b"\n\n"
+SSE_DONE_FRAME = SSE_DATA_PREFIX + b"[DONE]" + SSE_FRAME_END
+# 流式数据块模板中 delta 内容的占位标记
+_CONTENT_MARKER = b'"content":""'
+
+# 可用模型列表是静态的，在导入时序列化一次
+_MODELS_BYTES = orjson.dumps(
+    {
+        "data": [
+            {"id": "claude-3-7-sonnet-20250219"},
+            {"id": "claude-3-7-sonnet-20250219-think"},
+        ]
+    }
+)
+
 
 async def parse_and_validate_request(request: Request) -> ChatCompletionRequest:
     """
     解析并验证聊天完成请求
     """
+    max_body_size = config_instance.max_request_body_size
+
+    # 在读取请求体之前根据 Content-Length 拒绝过大的请求
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的 Content-Length")
+    if content_length > max_body_size:
+        logger.error(f"请求体过大: {content_length} 字节")
+        raise HTTPException(status_code=413, detail="请求体过大")
+
+    # 分块读取请求体，未声明 Content-Length（如分块传输）时同样限制大小
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_body_size:
+            logger.error(f"请求体过大: 超过 {max_body_size} 字节")
+            raise HTTPException(status_code=413, detail="请求体过大")
+
     # 获取请求体数据
     try:
-        json_data = await request.json()
+        json_data = orjson.loads(body)
+        # 解析后立即释放原始字节，降低并发大请求时的内存占用
+        del body
 
-        # 使用 pydantic 模型验证并更新请求
-        chat_completion_request = ChatCompletionRequest(**json_data)
+        # 使用预先构建的 pydantic 校验器验证请求
+        chat_completion_request = _REQUEST_ADAPTER.validate_python(json_data)
     except Exception as e:
         logger.error(f"无效的请求格式: {e}")
         raise HTTPException(status_code=400, detail=f"无效的请求: {str(e)}")
@@ -46,26 +85,36 @@ async def health_check_handler(request: Request):
     return {"status": "ok"}
 
 
-async def modules_handler(authorized: bool = Depends(verify_token)):
+async def modules_handler():
     """获取可用模型处理函数"""
-    models = [
-        {"id": "claude-3-7-sonnet-20250219"},
-        {"id": "claude-3-7-sonnet-20250219-think"},
-    ]
-    return {"data": models}
+    return Response(content=_MODELS_BYTES, media_type="application/json")
+
+
+async def _prepend(
+    first_event: Dict[str, Any], generator: AsyncGenerator[Dict[str, Any], None]
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """在异步生成器前补回已预读的事件"""
+    yield first_event
+    async for event in generator:
+        yield event
 
 
-async def chat_completions_handler(
-    request: Request, authorized: bool = Depends(verify_token)
-):
+async def chat_completions_handler(request: Request):
     """处理聊天完成请求"""
     # 验证请求
     chat_request: ChatCompletionRequest = await parse_and_validate_request(request)
 
+    # 提示只构建一次，各次重试复用
+    prompt, image_data = await claude_pipeline.build_prompt(chat_request)
+
     # 使用重试机制
     success = False  # 标记是否成功处理
     for i in range(config_instance.retry_count + 1):  # +1 是为了确保至少尝试一次
-        session = get_next_session()
+        try:
+            session = await session_pool.acquire()
+        except asyncio.TimeoutError:
+            # 所有会话都在冷却中
+            session = None
 
         if not session:
             logger.error(f"无法获取模型 {chat_request.model} 的会话")
@@ -76,59 +125,90 @@ async def chat_completions_handler(
             logger.info("正在尝试另一个会话")
             continue  # 继续下一次重试
 
-        logger.info(f"使用模型 {chat_request.model} 的会话: {session.session_key}")
+        logger.debug(
+            "使用模型 {} 的会话: {}", chat_request.model, _mask(session.session_key)
+        )
 
         # 处理请求并生成响应流
-        response_generator = claude_pipeline.pipline(chat_request, session)
+        response_generator = claude_pipeline.pipline(
+            chat_request, session, prompt, image_data
+        )
 
-        # 如果是流式响应，直接返回StreamingResponse
+        # 如果是流式响应，返回StreamingResponse
         if chat_request.stream:
+            # 响应头发送后无法再重试，因此先预读第一个事件，
+            # 若上游在开始输出前即失败，则换下一个会话重试
+            first_event = await anext(
+                response_generator, {"type": "error", "content": "响应流意外结束"}
+            )
+            if first_event.get("type") == "error":
+                logger.error(f"从 Claude 收到错误事件: {first_event.get('content')}")
+                # 只有上游或会话本身出错时才让会话冷却，请求内容引起的错误不影响会话
+                if first_event.get("session_failed"):
+                    session_pool.mark_failed(session)
+                await response_generator.aclose()
+                continue
 
-            async def generate():
-                async for event in response_generator:
-                    # 检查客户端是否断开连接
-                    if await request.is_disconnected():
-                        logger.warning("客户端断开连接")
-                        # 客户端断开，停止生成
-                        break  # 使用 break 退出生成器循环
+            async def generate(first_event, response_generator):
+                # 每个响应的 id/created/model 固定不变，只有 delta 内容随事件变化。
+                # 预先序列化一次数据块，以内容为界切成前后两段字节，之后每个事件
+                # 只需用 orjson 编码内容字符串再拼接
+                # 字段结构与 OpenAIStreamResponse 保持一致
+                frame = orjson.dumps(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": chat_request.model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "delta": {"content": ""},
+                                "logprobs": None,
+                                "finish_reason": None,
+                            }
+                        ],
+                    }
+                )
+                # 其他字段中的引号都会被转义，该标记在序列化结果中只会出现一次
+                head, _, tail = frame.partition(_CONTENT_MARKER)
+                prefix = SSE_DATA_PREFIX + head + b'"content":'
+                suffix = tail + SSE_FRAME_END
 
-                    event_type = event.get("type")
-                    event_content = event.get("content", "")
+                # 客户端断开由 StreamingResponse 自行处理：它会监听断开消息并取消
+                # 本生成器（或在写入失败时终止），aclosing 保证上游流随之关闭，
+                # 因此无需逐个事件轮询 request.is_disconnected()
+                async with aclosing(response_generator):
+                    async for event in _prepend(first_event, response_generator):
+                        event_type = event.get("type")
+                        event_content = event.get("content", "")
 
-                    if event_type == "error":
-                        logger.error(f"从 Claude 收到错误事件: {event_content}")
-                        # 收到错误，停止当前会话的处理，进入下一次重试
-                        # 这里不直接raise HTTPException，而是让外层循环处理重试
-                        # 可以考虑发送一个错误标记给客户端，或者直接断开流
-                        # 为了简化，这里直接break，依赖外层重试
-                        break
+                        if event_type == "error":
+                            logger.error(f"从 Claude 收到错误事件: {event_content}")
+                            # 收到错误，停止当前会话的处理，进入下一次重试
+                            # 这里不直接raise HTTPException，而是让外层循环处理重试
+                            # 可以考虑发送一个错误标记给客户端，或者直接断开流
+                            # 为了简化，这里直接break，依赖外层重试
+                            break
 
-                    elif event_type in ["text", "thinking"]:
-                        # 创建SSE格式的响应
-                        resp = OpenAIStreamResponse(
-                            choices=[
-                                StreamChoice(
-                                    index=0,
-                                    delta=Delta(content=event_content),
-                                )
-                            ]
-                        )
-                        json_data = resp.model_dump_json()
-                        logger.debug(f"输出流式数据: {json_data}")
-                        yield f"data: {json_data}\n\n"
+                        elif event_type in ["text", "thinking"]:
+                            # 创建SSE格式的响应，只序列化内容字符串
+                            data = prefix + orjson.dumps(event_content) + suffix
+                            logger.debug("输出流式数据: {}", data)
+                            yield data
 
-                    elif event_type == "done":
-                        # 发送结束标记
-                        logger.debug("发送流结束标记 [DONE]")
-                        yield "data: [DONE]\n\n"
-                        break
+                        elif event_type == "done":
+                            # 发送结束标记
+                            logger.debug("发送流结束标记 [DONE]")
+                            yield SSE_DONE_FRAME
+                            break
 
                 # 如果循环因错误或客户端断开而中断，确保不会标记成功
                 # success 变量在外层循环中判断
 
             # 直接返回 StreamingResponse
             return StreamingResponse(
-                generate(),
+                generate(first_event, response_generator),
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
@@ -137,44 +217,60 @@ async def chat_completions_handler(
                 },
             )
         else:
-            # 非流式响应，收集完整文本
-            full_text = ""
-            async for event in response_generator:
-                event_type = event.get("type")
-                event_content = event.get("content", "")
+            # 非流式响应，收集完整文本片段，成功后一次性拼接
+            text_parts: List[str] = []
+            async with aclosing(response_generator):
+                async for event in response_generator:
+                    event_type = event.get("type")
+                    event_content = event.get("content", "")
 
-                if event_type == "error":
-                    logger.error(f"从 Claude 收到错误事件: {event_content}")
-                    success = False  # 标记处理失败
-                    break  # 收到错误，停止当前会话的处理，进入下一次重试
+                    if event_type == "error":
+                        logger.error(f"从 Claude 收到错误事件: {event_content}")
+                        if event.get("session_failed"):
+                            session_pool.mark_failed(session)
+                        success = False  # 标记处理失败
+                        break  # 收到错误，停止当前会话的处理，进入下一次重试
 
-                elif event_type in ["text", "thinking"]:
-                    full_text += event_content
+                    elif event_type in ["text", "thinking"]:
+                        text_parts.append(event_content)
 
-                elif event_type == "done":
-                    success = True  # 标记成功完成
-                    break  # 正常结束循环
+                    elif event_type == "done":
+                        success = True  # 标记成功完成
+                        break  # 正常结束循环
 
             if success:
-                # 返回完整响应，创建OpenAI格式的响应
-                response = OpenAIResponse(
-                    model=chat_request.model,
-                    choices=[
-                        NoStreamChoice(
-                            index=0,
-                            message=Message(role="assistant", content=full_text),
-                            finish_reason="stop",
-                        )
-                    ],
-                    usage=Usage(
-                        prompt_tokens=0,  # 这里可以添加实际的token计数，如果有的话
-                        completion_tokens=0,
-                        total_tokens=0,
-                    ),
+                # 返回完整响应，直接序列化字典以绕过 pydantic
+                # 字段结构与 OpenAIResponse 保持一致
+                response_bytes = orjson.dumps(
+                    {
+                        "id": str(uuid.uuid4()),
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": chat_request.model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {
+                                    "role": "assistant",
+                                    "content": "".join(text_parts),
+                                    "refusal": None,
+                                    "annotation": None,
+                                },
+                                "logprobs": None,
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {
+                            # 这里可以添加实际的token计数，如果有的话
+                            "prompt_tokens": 0,
+                            "completion_tokens": 0,
+                            "total_tokens": 0,
+                        },
+                    }
                 )
 
-                logger.debug(f"返回非流式响应: {response.model_dump_json()}")
-                return response
+                logger.debug("返回非流式响应: {}", response_bytes)
+                return Response(content=response_bytes, media_type="application/json")
 
         # 如果当前会话处理失败 (success is False)，外层循环会尝试下一个会话
 
@@ -2,13 +2,110 @@
 消息处理模块，负责格式化和处理聊天消息。
 """
 
-from typing import List, Dict, Any
+import functools
+from typing import Any, Dict, List, Tuple
 from loguru import logger
 from pydantic import BaseModel
 
 from claude2api.config import get_config
 
 
+# 获取配置实例
+config_instance = get_config()
+
+# 禁用 artifacts 时加在提示开头的说明
+ARTIFACTS_DISABLED_HEADER = "System: Forbidden to use <antArtifac> </antArtifac> to wrap code blocks, use markdown syntax instead, which means wrapping code blocks with ``` ```\n\n"
+
+# 角色到前缀的映射
+ROLE_PREFIXES = {
+    "system": "System: ",
+    "user": "Human: ",
+    "assistant": "Assistant: ",
+}
+
+
+@functools.lru_cache(maxsize=16)
+def role_prefix_for(role: str) -> str:
+    """查找角色对应的前缀，结果按角色缓存
+
+    角色取值很少，缓存命中后连大小写转换也可以省去。
+
+    Args:
+        role: 角色名称
+
+    Returns:
+        str: 角色对应的前缀，未知角色返回 "Unknown: "
+    """
+    prefix = ROLE_PREFIXES.get(role)
+    if prefix is not None:
+        return prefix
+    return ROLE_PREFIXES.get(role.lower(), "Unknown: ")
+
+
+def build_prompt(
+    messages: List[Dict[str, Any]],
+    header: str,
+    use_role_prefix: bool = True,
+) -> Tuple[str, List[str]]:
+    """将消息数组拼接为提示文本并提取图片
+
+    请求处理中唯一的 CPU 密集部分，热点方法均绑定为局部变量以减少属性查找。
+
+    Args:
+        messages: 消息列表
+        header: 提示开头的固定文本
+        use_role_prefix: 是否在每条消息前添加角色前缀
+
+    Returns:
+        Tuple[str, List[str]]: 提示文本和图片数据列表
+    """
+    # 使用列表收集片段，最后一次性拼接，避免字符串反复 += 的二次复杂度
+    parts: List[str] = [header]
+    img_data_list: List[str] = []
+    append = parts.append
+    append_image = img_data_list.append
+    # 禁用角色前缀时不读取 role，非字符串的 role 也不会报错
+    role_prefix = role_prefix_for if use_role_prefix else None
+
+    # 处理每条消息
+    for msg in messages:
+        # 检查消息是否有效
+        if "role" not in msg or "content" not in msg:
+            continue
+
+        content = msg["content"]
+        if role_prefix is not None:
+            append(role_prefix(msg["role"]))
+
+        # 处理不同类型的内容
+        if isinstance(content, str):
+            # 直接是字符串类型
+            append(content)
+            append("\n\n")
+        elif isinstance(content, list):
+            # 内容是列表类型
+            for item in content:
+                if not isinstance(item, dict):
+                    continue
+
+                # 每个键只查找一次，缺失时 get 返回 None
+                item_type = item.get("type")
+                if item_type == "text":
+                    text = item.get("text")
+                    if text is not None:
+                        append(text)
+                        append("\n\n")
+                elif item_type == "image_url":
+                    # 提取图片URL并添加到图片列表
+                    image_url = item.get("image_url")
+                    if isinstance(image_url, dict):
+                        url = image_url.get("url")
+                        if url is not None:
+                            append_image(url)
+
+    return "".join(parts), img_data_list
+
+
 class ChatMessage(BaseModel):
     """聊天消息模型"""
 
@@ -21,95 +118,33 @@ class MessageProcessor:
 
     def __init__(self):
         """初始化消息处理器"""
-        self.config = get_config()
-        self.prompt = ""
-        self.img_data_list = []
+        self.config = config_instance
+        # 配置加载后不可变，预先取出每个请求都要读取的配置项
+        self._no_role_prefix = self.config.no_role_prefix
+        self._header = ""
+        # 如果配置禁用了 artifacts
+        if self.config.prompt_disable_artifacts:
+            self._header = ARTIFACTS_DISABLED_HEADER
 
-    def get_role_prefix(self, role: str) -> str:
-        """获取角色前缀
+    def process_messages(
+        self, messages: List[Dict[str, Any]]
+    ) -> Tuple[str, List[str]]:
+        """处理消息数组为提示并提取图片
+
+        处理器本身不保存请求状态，可以安全地在并发请求间共享。
 
         Args:
-            role: 角色名称
+            messages: 消息列表
 
         Returns:
-            str: 角色对应的前缀
+            Tuple[str, List[str]]: 提示文本和图片数据列表
         """
-        # 如果配置指定不使用角色前缀，则返回空字符串
-        if hasattr(self.config, "no_role_prefix") and self.config.no_role_prefix:
-            return ""
-
-        # 根据角色返回对应前缀
-        role_map = {
-            "system": "System: ",
-            "user": "Human: ",
-            "assistant": "Assistant: ",
-        }
-        # 返回对应的角色前缀，如果角色不在映射中则返回 "Unknown: "
-        return role_map.get(role.lower(), "Unknown: ")
-
-    def process_messages(self, messages: List[Dict[str, Any]]) -> None:
-        """处理消息数组为提示并提取图片
+        prompt, img_data_list = build_prompt(
+            messages, self._header, not self._no_role_prefix
+        )
 
-        Args:
-            messages: 消息列表
-        """
-        self.reset()  # 重置处理器状态
+        # 调试输出，使用 loguru 的参数格式化，日志级别未启用时不会格式化大段提示
+        logger.debug("Processed prompt: {}", prompt)
+        logger.debug("Image data list: {}", img_data_list)
 
-        # 如果配置禁用了 artifacts
-        if (
-            hasattr(self.config, "prompt_disable_artifacts")
-            and self.config.prompt_disable_artifacts
-        ):
-            self.prompt += "System: Forbidden to use <antArtifac> </antArtifac> to wrap code blocks, use markdown syntax instead, which means wrapping code blocks with ``` ```\n\n"
-
-        # 处理每条消息
-        for msg in messages:
-            # 检查消息是否有效
-            if "role" not in msg:
-                continue
-
-            role = msg["role"]
-            if "content" not in msg:
-                continue
-
-            content = msg["content"]
-            role_prefix = self.get_role_prefix(role)
-            self.prompt += role_prefix
-
-            # 处理不同类型的内容
-            if isinstance(content, str):
-                # 直接是字符串类型
-                self.prompt += content + "\n\n"
-            elif isinstance(content, list):
-                # 内容是列表类型
-                for item in content:
-                    if not isinstance(item, dict) or "type" not in item:
-                        continue
-
-                    item_type = item["type"]
-                    if item_type == "text" and "text" in item:
-                        self.prompt += item["text"] + "\n\n"
-                    elif item_type == "image_url" and "image_url" in item:
-                        # 提取图片URL并添加到图片列表
-                        if (
-                            isinstance(item["image_url"], dict)
-                            and "url" in item["image_url"]
-                        ):
-                            self.img_data_list.append(item["image_url"]["url"])
-
-        # 调试输出
-        logger.debug(f"Processed prompt: {self.prompt}")
-        logger.debug(f"Image data list: {self.img_data_list}")
-
-    def reset(self) -> None:
-        """重置处理器状态"""
-        self.prompt = ""
-        self.img_data_list = []
-
-    def get_prompt(self) -> str:
-        """获取处理后的Prompt"""
-        return self.prompt
-
-    def get_image_data(self) -> List[str]:
-        """获取处理后的图片数据列表"""
-        return self.img_data_list
+        return prompt, img_data_list
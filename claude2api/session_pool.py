@@ -0,0 +1,99 @@
+"""
+会话池模块，负责在多个 Claude 会话之间轮询分配，并让失败的会话冷却。
+"""
+
+import asyncio
+from typing import List, Set
+from loguru import logger
+
+from claude2api.config import _mask, get_config, SessionInfo
+
+# 获取配置实例
+config_instance = get_config()
+
+# 所有会话均在冷却时，等待可用会话的最长时间（秒）
+ACQUIRE_TIMEOUT = 5
+
+
+class SessionPool:
+    """基于 asyncio.Queue 的会话轮询池
+
+    取出的会话会立即放回队尾，因此同一会话可以同时服务多个请求；
+    被标记为失败的会话在冷却期内不再参与轮询，冷却结束后重新入队。
+    """
+
+    def __init__(self, sessions: List[SessionInfo], cooldown: float):
+        """初始化会话池
+
+        Args:
+            sessions: 会话信息列表
+            cooldown: 失败会话的冷却时间（秒）
+        """
+        self.cooldown = cooldown
+        self.size = len(sessions)
+        self.queue: asyncio.Queue[SessionInfo] = asyncio.Queue()
+        for session in sessions:
+            self.queue.put_nowait(session)
+
+        # 正在冷却的会话，以及已从队列中移出、等待冷却结束后放回的会话
+        self._cooling: Set[str] = set()
+        self._parked: Set[str] = set()
+
+    async def acquire(self) -> SessionInfo:
+        """获取下一个可用会话
+
+        Returns:
+            SessionInfo: 会话信息
+
+        Raises:
+            ValueError: 未配置任何会话时抛出
+            asyncio.TimeoutError: 所有会话都在冷却且超时仍无可用会话时抛出
+        """
+        if not self.size:
+            logger.error("config session 字段错误")
+            raise ValueError("config session 字段错误")
+
+        while True:
+            # 队列非空时直接取出，只有所有会话都在冷却时才需要带超时等待
+            try:
+                session = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                session = await asyncio.wait_for(self.queue.get(), ACQUIRE_TIMEOUT)
+            if session.session_key in self._cooling:
+                # 冷却中的会话移出轮询，由冷却回调放回
+                self._parked.add(session.session_key)
+                continue
+
+            # 立即放回队尾，实现轮询
+            self.queue.put_nowait(session)
+            return session
+
+    def mark_failed(self, session: SessionInfo) -> None:
+        """将会话标记为失败，使其在冷却期内不再被分配
+
+        Args:
+            session: 会话信息
+        """
+        if session.session_key in self._cooling:
+            return
+
+        # 至少保留一个会话参与轮询，避免所有请求都在等待冷却
+        if len(self._cooling) + 1 >= self.size:
+            return
+
+        self._cooling.add(session.session_key)
+        asyncio.get_running_loop().call_later(self.cooldown, self._restore, session)
+        logger.warning(
+            "会话 {} 进入 {} 秒冷却", _mask(session.session_key), self.cooldown
+        )
+
+    def _restore(self, session: SessionInfo) -> None:
+        """冷却结束，将会话放回轮询"""
+        self._cooling.discard(session.session_key)
+        if session.session_key in self._parked:
+            self._parked.discard(session.session_key)
+            self.queue.put_nowait(session)
+
+
+# 创建单例实例供全局使用
+session_pool = SessionPool(config_instance.sessions, config_instance.session_cooldown)